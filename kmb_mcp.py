@@ -4,23 +4,53 @@ KMB Bus MCP Server
 
 This server provides tools to query KMB bus information through MCP.
 """
+import asyncio
 import httpx
 import os
 import logging
 import uvicorn
 
-from typing import Dict, List, Optional, Any, Union
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Any, Union
 from mcp.server.fastmcp import FastMCP
 from starlette.middleware.cors import CORSMiddleware
 from utils import handle as handle_utils
 
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
 
-logging.basicConfig(level=logging.INFO)
+
+# Log level for the server and uvicorn, taken from LOG_LEVEL
+LOG_LEVELS = ("critical", "error", "warning", "info", "debug")
+requested_log_level = os.getenv("LOG_LEVEL", "info").lower()
+LOG_LEVEL = requested_log_level if requested_log_level in LOG_LEVELS else "info"
+
+logging.basicConfig(level=LOG_LEVEL.upper())
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger.setLevel(LOG_LEVEL.upper())
+if requested_log_level != LOG_LEVEL:
+    logger.warning(
+        "Unknown LOG_LEVEL %r, using 'info' instead (expected one of: %s)",
+        requested_log_level,
+        ", ".join(LOG_LEVELS),
+    )
+
+# Keep references to background tasks so they are not garbage collected
+background_tasks = set()
+
+@asynccontextmanager
+async def lifespan(server: FastMCP) -> AsyncIterator[Dict]:
+    """Start warming the list caches as soon as a server session starts."""
+    task = asyncio.create_task(warm_cache())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    yield {}
 
 # Initialize MCP server
-mcp = FastMCP("kmb-bus")
+mcp = FastMCP("kmb-bus", lifespan=lifespan)
 
 # API endpoints
 BASE_URL = "https://data.etabus.gov.hk/v1/transport/kmb"
@@ -34,20 +64,53 @@ ETA_URL = f"{BASE_URL}/eta"
 STOP_ETA_URL = f"{BASE_URL}/stop-eta"
 ROUTE_ETA_URL = f"{BASE_URL}/route-eta"
 
+# Display text for the route bound codes used by the API
+BOUND_TEXT = {"I": "Inbound", "O": "Outbound"}
+BOUND_ARROW = {"I": "←", "O": "→"}
+
 # HTTP client
-http_client = httpx.AsyncClient(timeout=30.0)
+# All endpoints live on one host, so a single HTTP/2 connection can multiplex
+# the concurrent requests issued by the tools instead of opening new sockets.
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(connect=2.0, read=10.0, write=5.0, pool=1.0),
+    limits=httpx.Limits(
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=60.0,
+    ),
+)
+
+# Upper bound on concurrent requests fanned out by a single tool call
+MAX_CONCURRENT_REQUESTS = 20
 
 # Cache for API responses to avoid redundant calls
 cache = {
     "route_list": None,
     "stop_list": None,
     "route_stop_list": None,
-    "last_update": None
 }
 
-async def fetch_api(url: str) -> Dict:
+# Per-key locks so concurrent cache misses share a single fetch
+cache_locks = {}
+
+# Lifetime of cached list responses; they are refreshed in the background
+# after REFRESH_AFTER of it and persisted files older than it are ignored
+CACHE_TTL = 12 * 60 * 60
+
+# Directory where list responses are persisted across restarts
+CACHE_DIR = os.getenv("KMB_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "kmb")
+
+# Lookup structures derived from the cached lists, rebuilt when a list changes
+indexes = {}
+
+async def warm_cache() -> None:
+    """Load the route, stop and route-stop lists into the cache concurrently."""
+    await asyncio.gather(get_route_list(), get_stop_list(), get_route_stop_list())
+
+async def fetch_api(url: str, validators: Optional[Dict] = None) -> Dict:
     """Delegate to shared implementation with injected http_client."""
-    return await handle_utils.fetch_api(url, http_client)
+    return await handle_utils.fetch_api(url, http_client, validators)
 
 async def get_cached_data(cache_key: str, url: str) -> Dict:
     """Delegate to shared implementation with injected fetch and cache."""
@@ -56,6 +119,9 @@ async def get_cached_data(cache_key: str, url: str) -> Dict:
         url,
         fetch_api_func=fetch_api,
         cache=cache,
+        locks=cache_locks,
+        ttl=CACHE_TTL,
+        cache_dir=CACHE_DIR,
     )
 
 async def get_route_list() -> List:
@@ -88,6 +154,7 @@ async def get_route_details(route: str, direction: str = None, service_type: str
         get_route_list_func=get_route_list,
         fetch_api_func=fetch_api,
         route_url=ROUTE_URL,
+        indexes=indexes,
     )
 
 async def get_stop_details(stop_id: str) -> Dict:
@@ -124,6 +191,25 @@ async def find_stops_by_name(name: str) -> List:
     return await handle_utils.find_stops_by_name(
         name,
         get_stop_list_func=get_stop_list,
+        indexes=indexes,
+    )
+
+async def find_stops_by_names(names: List[str]) -> Dict[str, List]:
+    """Delegate to shared implementation; keep signature for tests."""
+    return await handle_utils.find_stops_by_names(
+        names,
+        get_stop_list_func=get_stop_list,
+        indexes=indexes,
+    )
+
+async def find_stops_near(lat: float, long: float, radius_km: float = 0.5) -> List:
+    """Delegate to shared implementation; keep signature for tests."""
+    return await handle_utils.find_stops_near(
+        lat,
+        long,
+        radius_km,
+        get_stop_list_func=get_stop_list,
+        indexes=indexes,
     )
 
 async def find_routes_by_destination(destination: str) -> List:
@@ -131,6 +217,7 @@ async def find_routes_by_destination(destination: str) -> List:
     return await handle_utils.find_routes_by_destination(
         destination,
         get_route_list_func=get_route_list,
+        indexes=indexes,
     )
 
 @mcp.tool()
@@ -147,14 +234,24 @@ async def get_next_bus(route: str, stop_name: str) -> str:
     if not stops:
         return f"Could not find any stops matching '{stop_name}'"
     
+    # Fetch ETA data for all matching stops concurrently, bounding the
+    # number of in-flight requests since broad names match many stops
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    async def fetch_eta(stop_id):
+        async with semaphore:
+            return await get_eta(stop_id, route)
+    
+    eta_results = await asyncio.gather(*(fetch_eta(stop["stop"]) for stop in stops))
+    
+    # Collect every output line in one list, separating stops by a blank line
     results = []
-    for stop in stops:
+    for stop, eta_data in zip(stops, eta_results):
         stop_id = stop["stop"]
         stop_name_en = stop["name_en"]
         
-        # Get ETA data
-        eta_data = await get_eta(stop_id, route)
-
+        if results:
+            results.append("")
         
         if not eta_data:
             results.append(f"No arrival data available for route {route} at stop '{stop_name_en}' ({stop_id})")
@@ -168,24 +265,19 @@ async def get_next_bus(route: str, stop_name: str) -> str:
             continue
         
         # Format ETA information
-        stop_results = [f"Arrivals for route {route} at '{stop_name_en}' ({stop_id}):"]
+        results.append(f"Arrivals for route {route} at '{stop_name_en}' ({stop_id}):")
         
         for eta in route_etas:
-            eta_time = eta.get("eta", None)
-            if eta_time :
-                eta_time = eta_time.split("+")[0].replace("T", " ")  # Format the timestamp
-            
+            eta_time = handle_utils.format_eta_time(eta.get("eta"))
             dest = eta.get("dest_tc", "") or eta.get("dest_en", "Unknown destination")
             remark = eta.get("rmk_tc", "") or eta.get("rmk_en", "")
             
             if remark:
-                stop_results.append(f"- {eta_time} to {dest} ({remark})")
+                results.append(f"- {eta_time} to {dest} ({remark})")
             else:
-                stop_results.append(f"- {eta_time} to {dest}")
-        
-        results.append("\n".join(stop_results))
+                results.append(f"- {eta_time} to {dest}")
     
-    return "\n\n".join(results)
+    return "\n".join(results)
 
 @mcp.tool()
 async def find_buses_to_destination(destination: str) -> str:
@@ -200,17 +292,14 @@ async def find_buses_to_destination(destination: str) -> str:
         return f"Could not find any routes going to '{destination}'"
     
     # Group routes by origin for better readability
-    routes_by_origin = {}
+    routes_by_origin = defaultdict(list)
     
     for route in matching_routes:
         origin = route.get("orig_en", "Unknown")
-        if origin not in routes_by_origin:
-            routes_by_origin[origin] = []
-        
         routes_by_origin[origin].append({
             "route": route["route"],
             "destination": route.get("dest_en", "Unknown"),
-            "bound": "Inbound" if route["bound"] == "I" else "Outbound"
+            "bound": BOUND_TEXT.get(route["bound"], "Outbound")
         })
     
     # Format the results
@@ -236,37 +325,42 @@ async def get_route_stops_info(route: str) -> str:
     if not route_details:
         return f"Could not find information for route {route}"
     
-    results = []
+    # Bound the number of in-flight stop lookups so long routes cannot
+    # exhaust the connection pool
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
     
-    for direction_info in route_details:
+    async def fetch_stop(stop_data):
+        async with semaphore:
+            return stop_data, await get_stop_details(stop_data["stop"])
+    
+    async def describe_direction(direction_info) -> List[str]:
         direction = direction_info["bound"]
         service_type = direction_info["service_type"]
         origin = direction_info.get("orig_en", "Unknown")
         destination = direction_info.get("dest_en", "Unknown")
         
-        direction_text = "Inbound" if direction == "I" else "Outbound"
-        results.append(f"Route {route} {direction_text} from {origin} to {destination}:")
+        direction_text = BOUND_TEXT.get(direction, "Outbound")
+        lines = [f"Route {route} {direction_text} from {origin} to {destination}:"]
         
         # Get stops for this direction
         stops_data = await get_route_stops(route, direction, service_type)
         
         if not stops_data:
-            results.append("  No stop information available")
-            continue
+            lines.append("  No stop information available")
+            return lines
         
         # Sort stops by sequence
         stops_data.sort(key=lambda x: x.get("seq", 0))
         
-        # Get full stop details for each stop
+        # Get full stop details for all stops concurrently
+        pairs = await asyncio.gather(*(fetch_stop(stop_data) for stop_data in stops_data))
+        
         stop_details = []
-        for stop_data in stops_data:
-            stop_id = stop_data["stop"]
-            stop_info = await get_stop_details(stop_id)
-            
+        for stop_data, stop_info in pairs:
             if "data" in stop_info:
                 stop_details.append({
                     "seq": stop_data.get("seq", 0),
-                    "stop_id": stop_id,
+                    "stop_id": stop_data["stop"],
                     "name": stop_info["data"].get("name_en", "Unknown"),
                     "lat": stop_info["data"].get("lat", 0),
                     "long": stop_info["data"].get("long", 0)
@@ -274,7 +368,13 @@ async def get_route_stops_info(route: str) -> str:
         
         # Add stop information to results
         for i, stop in enumerate(stop_details, 1):
-            results.append(f"  {i}. {stop['name']} (ID: {stop['stop_id']})")
+            lines.append(f"  {i}. {stop['name']} (ID: {stop['stop_id']})")
+        
+        return lines
+    
+    # Every direction is independent, so resolve them concurrently as well
+    directions = await asyncio.gather(*(describe_direction(d) for d in route_details))
+    results = [line for lines in directions for line in lines]
     
     return "\n\n".join(results)
 
@@ -321,21 +421,21 @@ async def get_all_routes_at_stop(stop_name: str) -> str:
     if not stops:
         return f"Could not find any stops matching '{stop_name}'"
     
-    results = []
+    # Get all route-stop combinations once for every matching stop
+    route_stops = await get_route_stop_list()
+    route_stops_by_stop = handle_utils.get_index(
+        "route_stop_list_by_stop",
+        route_stops,
+        lambda rows: handle_utils.group_by(rows, "stop"),
+        indexes,
+    )
     
+    routes_by_stop = {}
     for stop in stops:
         stop_id = stop["stop"]
-        stop_name_en = stop["name_en"]
-        
-        # Get all route-stop combinations
-        route_stops = await get_route_stop_list()
         
-        # Filter for this stop
-        stop_routes = [rs for rs in route_stops if rs["stop"] == stop_id]
-        
-        if not stop_routes:
-            results.append(f"No routes found for stop '{stop_name_en}' ({stop_id})")
-            continue
+        # Look up the route-stops for this stop
+        stop_routes = route_stops_by_stop.get(stop_id, [])
         
         # Group by route for better readability
         routes_info = {}
@@ -349,28 +449,57 @@ async def get_all_routes_at_stop(stop_name: str) -> str:
                 routes_info[key] = []
             routes_info[key].append(bound)
         
+        routes_by_stop[stop_id] = routes_info
+    
+    # Fetch full route information once per distinct route
+    unique_routes = list({
+        key.split(":")[0]
+        for routes_info in routes_by_stop.values()
+        for key in routes_info
+    })
+    route_details_map = dict(zip(
+        unique_routes,
+        await asyncio.gather(*(get_route_details(route) for route in unique_routes)),
+    ))
+    
+    # Collect every output line in one list, separating stops by a blank line
+    results = []
+    
+    for stop in stops:
+        stop_id = stop["stop"]
+        stop_name_en = stop["name_en"]
+        routes_info = routes_by_stop[stop_id]
+        
+        if results:
+            results.append("")
+        
+        if not routes_info:
+            results.append(f"No routes found for stop '{stop_name_en}' ({stop_id})")
+            continue
+        
         # Format results
-        stop_results = [f"Routes serving '{stop_name_en}' ({stop_id}):"]
+        results.append(f"Routes serving '{stop_name_en}' ({stop_id}):")
         
-        # Get full route information for each route
         for key, bounds in routes_info.items():
             route, service_type = key.split(":")
-            route_data = await get_route_details(route)
+            route_data = route_details_map[route]
             
             for r in route_data:
                 if r["service_type"] == service_type and r["bound"] in bounds:
                     origin = r.get("orig_en", "Unknown")
                     dest = r.get("dest_en", "Unknown")
-                    direction = "→" if r["bound"] == "O" else "←"
+                    direction = BOUND_ARROW.get(r["bound"], "←")
                     
-                    stop_results.append(f"- Route {route}: {origin} {direction} {dest}")
-        
-        results.append("\n".join(stop_results))
+                    results.append(f"- Route {route}: {origin} {direction} {dest}")
     
-    return "\n\n".join(results)
+    return "\n".join(results)
 
 def main():
     transport_mode = os.getenv("TRANSPORT", "stdio")
+
+    # Drive the event loop with uvloop where it is available
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     
     if transport_mode == "http":
         # HTTP mode with config extraction from URL parameters
@@ -393,7 +522,13 @@ def main():
         port = int(os.environ.get("PORT", 8011))
         print(f"Listening on port {port}")
 
-        uvicorn.run(app, host="0.0.0.0", port=port, log_level="debug")
+        uvicorn.run(
+            app,
+            host="0.0.0.0",
+            port=port,
+            loop="uvloop" if uvloop is not None else "asyncio",
+            log_level=LOG_LEVEL,
+        )
     
     else:
         # Optional: add stdio transport for backwards compatibility
@@ -22,13 +22,13 @@ async def run_integration_test():
     """Run a series of tests against the real KMB API"""
     print("🔍 Running integration tests against real KMB API...\n")
     
-    # Reset any cache
+    # Reset any cache and keep the persisted lists out of the test
     kmb_mcp.cache = {
         "route_list": None,
-        "stop_list": None, 
+        "stop_list": None,
         "route_stop_list": None,
-        "last_update": None
     }
+    kmb_mcp.CACHE_DIR = None
     
     # Test 1: Get route list
     print("📋 Testing get_route_list()...")
@@ -56,7 +56,7 @@ async def run_integration_test():
     # Test 3: Get route details
     print(f"\n🚌 Testing get_route_details() for route {test_route}...")
     route_details = await kmb_mcp.get_route_details(test_route)
-    if isinstance(route_details, list) and len(route_details) > 0:
+    if isinstance(route_details, tuple) and len(route_details) > 0:
         print(f"✅ Success! Retrieved details for route {test_route}")
         for details in route_details:
             print(f"📄 {details.get('bound', '?')} bound: {details.get('orig_en', 'Unknown')} to {details.get('dest_en', 'Unknown')}")
@@ -6,41 +6,395 @@ callables and values so that callers (e.g., kmb_mcp.py) can control
 HTTP clients, caching, constants, and allow easy test patching.
 """
 
-from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import bisect
+import logging
+import math
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import httpx
+import orjson
 
+logger = logging.getLogger(__name__)
 
-async def fetch_api(url: str, http_client: httpx.AsyncClient) -> Dict:
+# Fraction of an entry's ttl after which it is refreshed in the background
+REFRESH_AFTER = 0.8
+
+# Fraction of the ttl to wait before retrying a failed background refresh
+REFRESH_RETRY_AFTER = 0.05
+
+# Joins the searchable names in a name index; never part of a name itself
+NAME_SEPARATOR = "\x00"
+
+# Length of one degree of latitude, used to turn degrees into kilometres
+KM_PER_DEGREE = 111.32
+
+
+async def fetch_api(
+    url: str,
+    http_client: httpx.AsyncClient,
+    validators: Optional[Dict[str, Optional[str]]] = None,
+) -> Dict:
     """
     Fetch data from an API endpoint using the provided http_client.
+
+    When a validators dict is given, its "etag" and "last_modified" values
+    make the request conditional and are replaced by those of the response;
+    a 304 Not Modified answer only updates the validators it carries and is
+    returned as {"not_modified": True}.
     """
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        response = await http_client.get(url)
-        response.raise_for_status()
-        return response.json()
-    except httpx.HTTPStatusError as e:
-        return {"error": f"HTTP error: {e}"}
+        if headers:
+            response = await http_client.get(url, headers=headers)
+        else:
+            response = await http_client.get(url)
+        # Check the status directly rather than raising and catching
+        # HTTPStatusError, since the caller only needs the error dict
+        if response.status_code >= 400:
+            return {
+                "error": f"HTTP error: {response.status_code} "
+                f"{response.reason_phrase} for url '{url}'"
+            }
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if response.status_code == 304:
+            # A 304 may repeat only some validators; keep the ones it omits
+            if validators is not None:
+                if etag:
+                    validators["etag"] = etag
+                if last_modified:
+                    validators["last_modified"] = last_modified
+            return {"not_modified": True}
+        data = orjson.loads(response.content)
+        if validators is not None:
+            validators["etag"] = etag
+            validators["last_modified"] = last_modified
+        return data
     except httpx.RequestError as e:
         return {"error": f"Request error: {e}"}
-    except Exception as e:
-        return {"error": f"Unexpected error: {e}"}
+    except orjson.JSONDecodeError as e:
+        return {"error": f"Invalid JSON response: {e}"}
 
 
 async def get_cached_data(
     cache_key: str,
     url: str,
-    fetch_api_func: Callable[[str], Awaitable[Dict]],
+    fetch_api_func: Callable[..., Awaitable[Dict]],
+    cache: Dict[str, Any],
+    *,
+    locks: Dict[str, asyncio.Lock],
+    ttl: float,
+    cache_dir: Optional[str] = None,
+) -> Dict:
+    """
+    Get data from cache, fetching it with the provided fetch function only
+    when nothing is cached for cache_key yet.
+
+    Once an entry has used REFRESH_AFTER of its ttl it is refreshed in the
+    background while the cached data keeps being served, however old it is;
+    callers only wait on the network for a cold cache, and concurrent cold
+    callers share a single fetch per key. Refreshes revalidate with the
+    ETag/Last-Modified validators of the previous response, so an unchanged
+    list costs a 304 without a body. Error responses are never cached: they
+    are returned only when there is no previous data to fall back on, and a
+    failed refresh is retried after REFRESH_RETRY_AFTER of the ttl.
+    When cache_dir is given, fetched data is also persisted there so that a
+    restarted process can skip the network while the files are fresh.
+    """
+    entry = cache.get(cache_key)
+    if entry is not None:
+        if time.monotonic() >= entry["refresh_at"] and entry["refresh_task"] is None:
+            entry["refresh_task"] = asyncio.create_task(
+                _refresh_cached_data(
+                    cache_key, url, fetch_api_func, cache, locks, ttl, cache_dir
+                )
+            )
+        return entry["data"]
+
+    async with locks.setdefault(cache_key, asyncio.Lock()):
+        # Another caller may have filled the entry while we were waiting
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return entry["data"]
+        if cache_dir:
+            persisted = await asyncio.to_thread(_load_persisted, cache_dir, cache_key, ttl)
+            if persisted is not None:
+                data, age = persisted
+                _store_entry(cache, cache_key, data, ttl, age)
+                return data
+        return await _fetch_into_cache(cache_key, url, fetch_api_func, cache, ttl, cache_dir)
+
+
+def _store_entry(
     cache: Dict[str, Any],
+    cache_key: str,
+    data: Dict,
+    ttl: float,
+    age: float = 0.0,
+    validators: Optional[Dict[str, Optional[str]]] = None,
+) -> None:
+    fetched_at = time.monotonic() - age
+    cache[cache_key] = {
+        "data": data,
+        "validators": validators or {},
+        "refresh_at": fetched_at + ttl * REFRESH_AFTER,
+        "refresh_task": None,
+    }
+
+
+async def _fetch_into_cache(
+    cache_key: str,
+    url: str,
+    fetch_api_func: Callable[..., Awaitable[Dict]],
+    cache: Dict[str, Any],
+    ttl: float,
+    cache_dir: Optional[str],
 ) -> Dict:
+    entry = cache.get(cache_key)
+    validators = dict(entry["validators"]) if entry is not None else {}
+    data = await fetch_api_func(url, validators=validators)
+    if "not_modified" in data and entry is not None:
+        # Keep the same data object so indexes built from it stay valid
+        _store_entry(cache, cache_key, entry["data"], ttl, validators=validators)
+        if cache_dir:
+            await asyncio.to_thread(_touch_persisted, cache_dir, cache_key)
+        return entry["data"]
+    if "error" in data:
+        if entry is not None:
+            # Keep serving the previous data until the upstream recovers
+            logger.warning("Could not refresh %s, serving cached data: %s", cache_key, data["error"])
+            return entry["data"]
+        return data
+    if "not_modified" not in data:
+        await asyncio.to_thread(share_repeated_strings, data.get("data"))
+        _store_entry(cache, cache_key, data, ttl, validators=validators)
+        if cache_dir:
+            await asyncio.to_thread(_persist, cache_dir, cache_key, data)
+    return data
+
+
+async def _refresh_cached_data(
+    cache_key: str,
+    url: str,
+    fetch_api_func: Callable[..., Awaitable[Dict]],
+    cache: Dict[str, Any],
+    locks: Dict[str, asyncio.Lock],
+    ttl: float,
+    cache_dir: Optional[str],
+) -> None:
+    entry = cache[cache_key]
+    try:
+        async with locks.setdefault(cache_key, asyncio.Lock()):
+            await _fetch_into_cache(cache_key, url, fetch_api_func, cache, ttl, cache_dir)
+    finally:
+        # Only matters when the refresh failed and the old entry is kept;
+        # wait before the next attempt instead of retrying on every call
+        if cache.get(cache_key) is entry:
+            entry["refresh_at"] = time.monotonic() + ttl * REFRESH_RETRY_AFTER
+        entry["refresh_task"] = None
+
+
+def share_repeated_strings(rows: Any) -> None:
+    """
+    Make rows reuse one string object per distinct string value, in place.
+
+    List responses repeat the same few values (company, bound, service type,
+    route and stop ids) in every row, and the JSON parser allocates a new
+    string for each occurrence.
+    """
+    if not isinstance(rows, list):
+        return
+    pool: Dict[str, str] = {}
+    for row in rows:
+        if isinstance(row, dict):
+            for field, value in row.items():
+                if type(value) is str:
+                    row[field] = pool.setdefault(value, value)
+
+
+def _persisted_path(cache_dir: str, cache_key: str) -> str:
+    return os.path.join(cache_dir, f"{cache_key}.json")
+
+
+def _load_persisted(cache_dir: str, cache_key: str, ttl: float) -> Optional[Tuple[Dict, float]]:
+    """
+    Return the persisted data for cache_key and its age in seconds, or None
+    if there is no readable file younger than ttl.
+    """
+    path = _persisted_path(cache_dir, cache_key)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if not 0 <= age < ttl:
+            return None
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    share_repeated_strings(data.get("data"))
+    return data, age
+
+
+def _persist(cache_dir: str, cache_key: str, data: Dict) -> None:
+    path = _persisted_path(cache_dir, cache_key)
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(data))
+        # Replace atomically so readers never see a partially written file
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not persist %s to %s: %s", cache_key, path, e)
+
+
+def _touch_persisted(cache_dir: str, cache_key: str) -> None:
+    # The upstream data is unchanged, so only restart the file's ttl
+    try:
+        os.utime(_persisted_path(cache_dir, cache_key))
+    except OSError:
+        pass
+
+
+def get_index(
+    index_key: str,
+    rows: List,
+    build_index: Callable[[List], Any],
+    indexes: Dict[str, Any],
+) -> Any:
+    """
+    Return the lookup structure built from rows, building it on first use.
+
+    The index is rebuilt whenever rows is not the same list object it was
+    built from, so refreshing the underlying cache invalidates it implicitly.
+    """
+    entry = indexes.get(index_key)
+    if entry is None or entry[0] is not rows:
+        entry = (rows, build_index(rows))
+        indexes[index_key] = entry
+    return entry[1]
+
+
+def group_by(rows: List[Dict[str, Any]], field: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Group rows into lists keyed by the value of field, preserving order.
+    """
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(row[field], []).append(row)
+    return groups
+
+
+def build_name_index(rows: List[Dict[str, Any]], fields: List[str]) -> Dict[str, Any]:
+    """
+    Concatenate the lowercased values of each field for every row into one
+    corpus string per field, recording the offset at which each row starts.
+
+    Keeping the fields apart lets an ASCII-only field, such as the English
+    names, be stored one byte per character and skipped by non-ASCII queries.
+    """
+    corpora = []
+    for field in fields:
+        values: List[str] = []
+        starts: List[int] = []
+        offset = 0
+        for row in rows:
+            value = (row.get(field) or "").lower()
+            starts.append(offset)
+            values.append(value)
+            offset += len(value) + len(NAME_SEPARATOR)
+        corpus = NAME_SEPARATOR.join(values)
+        corpora.append((corpus, starts, corpus.isascii()))
+    return {"rows": rows, "corpora": corpora}
+
+
+def search_name_index(index: Dict[str, Any], query: str) -> List:
+    """
+    Return the rows with a field containing query, case-insensitively.
+    An empty query matches nothing.
+
+    Each corpus is scanned with str.find, so the search runs in C and Python
+    only handles the matches: after each hit the scan resumes at the next row.
+    """
+    needle = query.lower()
+    rows = index["rows"]
+    if not needle or not rows or NAME_SEPARATOR in needle:
+        return []
+
+    needle_is_ascii = needle.isascii()
+    matched: List[int] = []
+    scanned = 0
+    for corpus, starts, corpus_is_ascii in index["corpora"]:
+        if corpus_is_ascii and not needle_is_ascii:
+            continue
+        scanned += 1
+        position = corpus.find(needle)
+        while position != -1:
+            row = bisect.bisect_right(starts, position) - 1
+            matched.append(row)
+            if row + 1 == len(starts):
+                break
+            position = corpus.find(needle, starts[row + 1])
+    if scanned > 1:
+        # A row matching in several fields is reported once, in row order
+        matched = sorted(set(matched))
+    return [rows[row] for row in matched]
+
+
+def build_location_index(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Sort the rows with a usable "lat"/"long" position by latitude, keeping
+    the parsed coordinates in parallel lists.
+    """
+    located = []
+    for row in rows:
+        try:
+            located.append((float(row["lat"]), float(row["long"]), row))
+        except (KeyError, TypeError, ValueError):
+            continue
+    located.sort(key=lambda item: item[0])
+    return {
+        "lats": [lat for lat, _, _ in located],
+        "longs": [long for _, long, _ in located],
+        "rows": [row for _, _, row in located],
+    }
+
+
+def search_location_index(
+    index: Dict[str, Any], lat: float, long: float, radius_km: float
+) -> List:
     """
-    Get data from cache or fetch it if not available using the provided
-    fetch function and cache store.
+    Return the rows within radius_km of (lat, long), nearest first.
+
+    Only the band of rows whose latitude is within the radius is examined;
+    distances use an equirectangular approximation, which is accurate at
+    city scale.
     """
-    if cache.get(cache_key) is None:
-        data = await fetch_api_func(url)
-        cache[cache_key] = data
-    return cache[cache_key]
+    lats = index["lats"]
+    longs = index["longs"]
+    rows = index["rows"]
+    lat_radius = radius_km / KM_PER_DEGREE
+    long_scale = math.cos(math.radians(lat))
+    limit = radius_km * radius_km
+
+    matches = []
+    low = bisect.bisect_left(lats, lat - lat_radius)
+    high = bisect.bisect_right(lats, lat + lat_radius)
+    for i in range(low, high):
+        dy = (lats[i] - lat) * KM_PER_DEGREE
+        dx = (longs[i] - long) * KM_PER_DEGREE * long_scale
+        distance = dx * dx + dy * dy
+        if distance <= limit:
+            matches.append((distance, i))
+    matches.sort()
+    return [rows[i] for _, i in matches]
 
 
 async def get_route_list(
@@ -81,11 +435,18 @@ async def get_route_details(
     get_route_list_func: Callable[[], Awaitable[List]],
     fetch_api_func: Callable[[str], Awaitable[Dict]],
     route_url: str,
+    indexes: Dict[str, Any],
 ) -> Any:
     if direction is None:
         routes = await get_route_list_func()
-        route_data = [r for r in routes if r["route"] == route]
-        return route_data
+        # Tuples, since the same groups are handed to every caller
+        routes_by_route = get_index(
+            "route_list_by_route",
+            routes,
+            lambda rows: {key: tuple(group) for key, group in group_by(rows, "route").items()},
+            indexes,
+        )
+        return routes_by_route.get(route, ())
 
     url = f"{route_url}/{route}/{direction}/{service_type}"
     return await fetch_api_func(url)
@@ -137,41 +498,88 @@ async def get_eta(
     return []
 
 
+def format_eta_time(eta_time: Optional[str]) -> Optional[str]:
+    """
+    Format an ISO 8601 timestamp such as "2023-04-01T12:10:00+08:00" as
+    "2023-04-01 12:10:00", dropping the UTC offset. Empty values are returned
+    unchanged.
+    """
+    if not eta_time:
+        return eta_time
+    offset = eta_time.find("+")
+    if offset != -1:
+        eta_time = eta_time[:offset]
+    return eta_time.replace("T", " ")
+
+
 async def find_stops_by_name(
     name: str,
     *,
     get_stop_list_func: Callable[[], Awaitable[List]],
+    indexes: Dict[str, Any],
+) -> List:
+    stops = await get_stop_list_func()
+    return search_name_index(_stop_name_index(stops, indexes), name)
+
+
+async def find_stops_by_names(
+    names: List[str],
+    *,
+    get_stop_list_func: Callable[[], Awaitable[List]],
+    indexes: Dict[str, Any],
+) -> Dict[str, List]:
+    """
+    Find the stops matching each of names, keyed by name.
+
+    The stop list and its name index are fetched once for the whole batch,
+    then the index is scanned once per distinct lowercased name; names that
+    only differ in case get their own copy of the shared matches.
+    """
+    stops = await get_stop_list_func()
+    index = _stop_name_index(stops, indexes)
+    matches_by_needle: Dict[str, List] = {}
+    results: Dict[str, List] = {}
+    for name in names:
+        needle = name.lower()
+        if needle not in matches_by_needle:
+            matches_by_needle[needle] = search_name_index(index, needle)
+        results[name] = list(matches_by_needle[needle])
+    return results
+
+
+async def find_stops_near(
+    lat: float,
+    long: float,
+    radius_km: float,
+    *,
+    get_stop_list_func: Callable[[], Awaitable[List]],
+    indexes: Dict[str, Any],
 ) -> List:
     stops = await get_stop_list_func()
-    matching_stops: List[Dict[str, Any]] = []
+    index = get_index("stop_list_by_location", stops, build_location_index, indexes)
+    return search_location_index(index, lat, long, radius_km)
 
-    for stop in stops:
-        if (
-            name.lower() in stop["name_en"].lower()
-            or (stop.get("name_tc") and name.lower() in stop["name_tc"].lower())
-        ):
-            matching_stops.append(stop)
 
-    return matching_stops
+def _stop_name_index(stops: List, indexes: Dict[str, Any]) -> Dict[str, Any]:
+    return get_index(
+        "stop_list_by_name",
+        stops,
+        lambda rows: build_name_index(rows, ["name_en", "name_tc"]),
+        indexes,
+    )
 
 
 async def find_routes_by_destination(
     destination: str,
     *,
     get_route_list_func: Callable[[], Awaitable[List]],
+    indexes: Dict[str, Any],
 ) -> List:
     routes = await get_route_list_func()
-    matching_routes: List[Dict[str, Any]] = []
-
-    for route in routes:
-        if (
-            destination.lower() in route["dest_en"].lower()
-            or (
-                route.get("dest_tc")
-                and destination.lower() in route["dest_tc"].lower()
-            )
-        ):
-            matching_routes.append(route)
-
-    return matching_routes
-
+    index = get_index(
+        "route_list_by_destination",
+        routes,
+        lambda rows: build_name_index(rows, ["dest_en", "dest_tc"]),
+        indexes,
+    )
+    return search_name_index(index, destination)